@@ -5,19 +5,27 @@ A simple Flask server for playing alarm sounds remotely.
 """
 
 import os
+import atexit
+import base64
+import binascii
+import hashlib
+import hmac
+import queue
+import secrets
 import threading
 import time
 import logging
-from functools import wraps
-from datetime import datetime, timedelta
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, wraps
 
-from flask import Flask, render_template, jsonify, request, Response
+import orjson
+from flask import Flask, render_template, request, Response, make_response
+from waitress import serve
+from werkzeug.datastructures import Authorization
 
-# Initialize pygame mixer for audio
 import pygame
 
-pygame.mixer.init()
-
 # =============================================================================
 # CONFIGURATION
 # =============================================================================
@@ -29,67 +37,237 @@ AUTH_ENABLED = True
 USERNAME = "admin"
 PASSWORD = "alarm123"
 
+# How long a login session cookie stays valid (seconds)
+SESSION_TTL = 12 * 3600
+
 # Path to your alarm sound file
 ALARM_FILE = "alarm.mp3"
 
+# Mixer buffer size in samples. Smaller means lower play latency; raise it
+# (e.g. 2048 or 4096) if playback stutters on slower machines.
+MIXER_BUFFER = 512
+
 # Server settings
 HOST = "0.0.0.0"  # Listen on all interfaces for LAN access
 PORT = 5000
+SERVER_THREADS = 16
+CONNECTION_LIMIT = 200
+
+# How long a serialized /api/status response is reused (seconds)
+STATUS_CACHE_TTL = 0.25
 
 # =============================================================================
 # LOGGING
 # =============================================================================
 
+# Request threads only enqueue records; a background listener does the I/O
+_log_formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+_log_handlers = [logging.StreamHandler(), logging.FileHandler("alarm_server.log")]
+for _handler in _log_handlers:
+    _handler.setFormatter(_log_formatter)
+
+_log_queue = queue.SimpleQueue()
+# The queue handler only renders the message; the listener's handlers add
+# the timestamp and level
 logging.basicConfig(
     level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler("alarm_server.log"),
-    ],
+    format="%(message)s",
+    handlers=[QueueHandler(_log_queue)],
 )
+log_listener = QueueListener(_log_queue, *_log_handlers)
+log_listener.start()
+atexit.register(log_listener.stop)
+
 logger = logging.getLogger(__name__)
 
+# =============================================================================
+# AUDIO INIT
+# =============================================================================
+
+pygame.mixer.pre_init(frequency=44100, size=-16, channels=2, buffer=MIXER_BUFFER)
+pygame.mixer.init()
+logger.info(f"Mixer initialized: {pygame.mixer.get_init()}")
+
+# The event queue needs the video subsystem; use the dummy driver so the
+# server keeps running headless.
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+pygame.display.init()
+
+# Posted when a single play finishes
+ALARM_END_EVENT = pygame.USEREVENT + 1
+
 # =============================================================================
 # APPLICATION STATE
 # =============================================================================
 
 app = Flask(__name__)
 
+# Runs the loop and delayed-stop workers
+executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="alarm")
+
 
 class AlarmState:
     """Manages the current state of the alarm system."""
 
     def __init__(self):
+        # Writers serialize on the lock; readers only check the flags.
+        # No flag set means idle.
         self.lock = threading.Lock()
-        self.status = "idle"  # idle, playing, looping, stopping_soon
+        self.playing_evt = threading.Event()
+        self.looping_evt = threading.Event()
+        self.stopping_evt = threading.Event()
+        self._status_events = {
+            "playing": self.playing_evt,
+            "looping": self.looping_evt,
+            "stopping_soon": self.stopping_evt,
+        }
         self.stop_event = threading.Event()
-        self.loop_thread = None
-        self.delayed_stop_thread = None
-        self.loop_end_time = None
-        self.volume = 1.0  # Default volume (0.0 to 1.0)
+        self.loop_future = None
+        self.delayed_stop_future = None
+        self.loop_end_monotonic = None  # time.monotonic() deadline of a loop
+        # Volume (0.0 to 1.0). Never guarded by the lock: it is a single float
+        # attribute, and reads/writes of it are atomic.
+        self.volume = 1.0
+        self.sound = None  # Decoded alarm sound, cached at startup
+        self.channel = None  # Channel the alarm is currently playing on
+        self.alarm_path = None  # Set once an alarm file has been found
+        self._info_generation = 0  # Bumped whenever the status info changes
+        # (monotonic timestamp, generation, JSON bytes)
+        self._info_cache = (0.0, -1, b"")
+        self._remaining_cache = (-1, "")  # (whole seconds, formatted string)
+
+    def _apply_status(self, status):
+        # Caller must hold the lock. Raise the new flag before dropping the
+        # old ones so readers never see a spurious idle in between.
+        target = self._status_events.get(status)
+        if target:
+            target.set()
+        for event in self._status_events.values():
+            if event is not target:
+                event.clear()
 
     def set_status(self, status):
         with self.lock:
-            self.status = status
-            logger.info(f"Status changed to: {status}")
+            self._apply_status(status)
+        self.invalidate_info()
+        logger.debug(f"Status changed to: {status}")
 
-    def get_status(self):
+    def start_session(self, status):
+        """Install a fresh stop event and status together.
+
+        Doing both under the lock means a concurrent stop_all either sees
+        the new session or runs entirely before it.
+        """
+        stop_event = threading.Event()
+        with self.lock:
+            self.stop_event = stop_event
+            self._apply_status(status)
+        self.invalidate_info()
+        logger.debug(f"Status changed to: {status}")
+        return stop_event
+
+    def _stop_locked(self):
+        # Caller must hold the lock
+        self.stop_event.set()
+        if self.channel:
+            # Clear the end event first so a manual stop isn't reported as
+            # the end of a later play
+            self.channel.set_endevent()
+            self.channel.stop()
+        self.loop_end_monotonic = None
+        self._apply_status("idle")
+
+    def stop(self):
+        """Stop the current session; return False if already idle."""
+        with self.lock:
+            if self.get_status() == "idle":
+                return False
+            self._stop_locked()
+        self.invalidate_info()
+        logger.debug("Status changed to: idle")
+        return True
+
+    def begin_delayed_stop(self):
+        """Mark the session as stopping soon and return its stop event.
+
+        Returns None if nothing is playing.
+        """
+        with self.lock:
+            if self.get_status() == "idle":
+                return None
+            self._apply_status("stopping_soon")
+            stop_event = self.stop_event
+        self.invalidate_info()
+        logger.debug("Status changed to: stopping_soon")
+        return stop_event
+
+    def finish_play(self):
+        """Return to idle once the play-once channel has actually finished."""
+        with self.lock:
+            # Drop end events left over from an earlier play or session
+            if self.get_status() != "playing" or not self.channel:
+                return False
+            if self.channel.get_busy():
+                return False
+            self._stop_locked()
+        self.invalidate_info()
+        logger.debug("Status changed to: idle")
+        return True
+
+    def end_session(self, stop_event):
+        """Stop the session owning stop_event, unless it has already ended."""
         with self.lock:
-            return self.status
+            if self.stop_event is not stop_event or stop_event.is_set():
+                return False
+            self._stop_locked()
+        self.invalidate_info()
+        logger.debug("Status changed to: idle")
+        return True
+
+    def get_status(self):
+        if self.stopping_evt.is_set():
+            return "stopping_soon"
+        if self.looping_evt.is_set():
+            return "looping"
+        if self.playing_evt.is_set():
+            return "playing"
+        return "idle"
+
+    def invalidate_info(self):
+        """Drop the cached status response so the next poll rebuilds it."""
+        self._info_generation += 1
+
+    def get_info_json(self):
+        """Get the status info as JSON bytes, reusing a recent encoding."""
+        now = time.monotonic()
+        generation = self._info_generation
+        ts, cached_generation, buf = self._info_cache
+        if cached_generation == generation and now - ts < STATUS_CACHE_TTL:
+            return buf
+        buf = orjson.dumps(self.get_info())
+        # If the state changed while building, this encoding is tagged with
+        # the old generation and never served from the cache
+        self._info_cache = (now, generation, buf)
+        return buf
 
     def get_info(self):
-        with self.lock:
-            info = {"status": self.status, "volume": int(self.volume * 100)}
-            if self.status == "looping" and self.loop_end_time:
-                remaining = self.loop_end_time - datetime.now()
-                if remaining.total_seconds() > 0:
-                    hours, remainder = divmod(int(remaining.total_seconds()), 3600)
+        status = self.get_status()
+        loop_end = self.loop_end_monotonic
+
+        info = {"status": status, "volume": int(self.volume * 100)}
+        if status == "looping" and loop_end:
+            secs = int(loop_end - time.monotonic())
+            if secs > 0:
+                cached_secs, text = self._remaining_cache
+                if secs != cached_secs:
+                    hours, remainder = divmod(secs, 3600)
                     minutes, seconds = divmod(remainder, 60)
-                    info["remaining"] = f"{hours}h {minutes}m {seconds}s"
-                else:
-                    info["remaining"] = "ending..."
-            return info
+                    text = "%dh %dm %ds" % (hours, minutes, seconds)
+                    self._remaining_cache = (secs, text)
+                info["remaining"] = text
+            else:
+                info["remaining"] = "ending..."
+        return info
 
 
 state = AlarmState()
@@ -99,9 +277,52 @@ state = AlarmState()
 # =============================================================================
 
 
+_USERNAME_BYTES = USERNAME.encode()
+_PASSWORD_BYTES = PASSWORD.encode()
+
+
 def check_auth(username, password):
-    """Verify username and password."""
-    return username == USERNAME and password == PASSWORD
+    """Verify username and password in constant time."""
+    username_ok = hmac.compare_digest(username.encode(), _USERNAME_BYTES)
+    password_ok = hmac.compare_digest(password.encode(), _PASSWORD_BYTES)
+    return username_ok & password_ok
+
+
+# Session cookies are signed with a per-process key, so a restart logs
+# everyone out
+SESSION_COOKIE = "sid"
+_SESSION_KEY = secrets.token_bytes(32)
+
+
+def _sign_session(payload):
+    return hmac.new(_SESSION_KEY, payload, hashlib.sha256).hexdigest().encode()
+
+
+def make_session_cookie():
+    """Create a signed session cookie value for the configured user."""
+    payload = f"{USERNAME}|{int(time.time()) + SESSION_TTL}".encode()
+    return base64.urlsafe_b64encode(payload + b"|" + _sign_session(payload)).decode()
+
+
+@lru_cache(maxsize=32)
+def session_expiry(cookie):
+    """Return the expiry time of a valid session cookie, or 0 if invalid."""
+    try:
+        payload, sig = base64.urlsafe_b64decode(cookie).rsplit(b"|", 1)
+    except (ValueError, binascii.Error):
+        return 0
+    if not hmac.compare_digest(sig, _sign_session(payload)):
+        return 0
+    return int(payload.rsplit(b"|", 1)[1])
+
+
+@lru_cache(maxsize=16)
+def check_auth_header(header):
+    """Verify a raw Authorization header, caching recent results."""
+    auth = Authorization.from_header(header)
+    if not auth or auth.type != "basic":
+        return False
+    return check_auth(auth.username, auth.password)
 
 
 def authenticate():
@@ -120,11 +341,22 @@ def requires_auth(f):
     def decorated(*args, **kwargs):
         if not AUTH_ENABLED:
             return f(*args, **kwargs)
-        auth = request.authorization
-        if not auth or not check_auth(auth.username, auth.password):
+        cookie = request.cookies.get(SESSION_COOKIE)
+        if cookie and session_expiry(cookie) > time.time():
+            return f(*args, **kwargs)
+        header = request.headers.get("Authorization")
+        if not header or not check_auth_header(header):
             logger.warning(f"Failed auth attempt from {request.remote_addr}")
             return authenticate()
-        return f(*args, **kwargs)
+        response = make_response(f(*args, **kwargs))
+        response.set_cookie(
+            SESSION_COOKIE,
+            make_session_cookie(),
+            max_age=SESSION_TTL,
+            httponly=True,
+            samesite="Strict",
+        )
+        return response
 
     return decorated
 
@@ -134,6 +366,7 @@ def requires_auth(f):
 # =============================================================================
 
 
+@lru_cache(maxsize=1)
 def get_alarm_path():
     """Get the full path to the alarm file."""
     if os.path.isabs(ALARM_FILE):
@@ -142,12 +375,29 @@ def get_alarm_path():
 
 
 def check_alarm_file():
-    """Check if alarm file exists and is readable."""
+    """Check if alarm file exists and is readable.
+
+    A sibling .wav or .ogg of ALARM_FILE is preferred when present, as
+    those decode much faster than MP3.
+    """
+    if state.alarm_path:
+        return True, state.alarm_path
     path = get_alarm_path()
-    if not os.path.exists(path):
-        logger.error(f"Alarm file not found: {path}")
-        return False, f"Alarm file not found: {path}"
-    return True, path
+    base = os.path.splitext(path)[0]
+    for candidate in (base + ".wav", base + ".ogg", path):
+        if os.path.exists(candidate):
+            state.alarm_path = candidate
+            return True, candidate
+    logger.error(f"Alarm file not found: {path}")
+    return False, f"Alarm file not found: {path}"
+
+
+def load_alarm_sound(path):
+    """Decode the alarm file once and cache it for later plays."""
+    if state.sound is None:
+        state.sound = pygame.mixer.Sound(path)
+        state.sound.set_volume(state.volume)
+    return state.sound
 
 
 def play_once():
@@ -157,26 +407,22 @@ def play_once():
         return False, path
 
     stop_all()
-    state.set_status("playing")
+    my_stop = state.start_session("playing")
 
     try:
-        pygame.mixer.music.load(path)
-        pygame.mixer.music.set_volume(state.volume)
-        pygame.mixer.music.play()
+        sound = load_alarm_sound(path)
+        with state.lock:
+            if state.stop_event is not my_stop or my_stop.is_set():
+                return False, "Stopped before playback started"
+            channel = sound.play(loops=0)
+            # end_event_watcher flips the status back to idle when this finishes
+            channel.set_endevent(ALARM_END_EVENT)
+            state.channel = channel
         logger.info("Playing alarm once")
-
-        # Monitor in background thread to update status when done
-        def monitor():
-            while pygame.mixer.music.get_busy():
-                time.sleep(0.1)
-            if state.get_status() == "playing":
-                state.set_status("idle")
-
-        threading.Thread(target=monitor, daemon=True).start()
         return True, "Playing alarm once"
     except Exception as e:
         logger.error(f"Error playing audio: {e}")
-        state.set_status("idle")
+        state.end_session(my_stop)
         return False, str(e)
 
 
@@ -187,79 +433,110 @@ def play_loop(duration_hours=6):
         return False, path
 
     stop_all()
-    state.set_status("looping")
-    state.stop_event.clear()
-    state.loop_end_time = datetime.now() + timedelta(hours=duration_hours)
+    # Set the deadline first; starting the session drops the cached status
+    state.loop_end_monotonic = time.monotonic() + duration_hours * 3600
+    # Each session gets its own event, so a concurrent stop can't be undone
+    # by clearing a shared one
+    my_stop = state.start_session("looping")
 
     def loop_worker():
         try:
-            pygame.mixer.music.load(path)
-            pygame.mixer.music.set_volume(state.volume)
-            pygame.mixer.music.play(loops=-1)  # -1 means infinite loop
+            sound = load_alarm_sound(path)
+            # The pool may start us late; don't play for a cancelled session
+            # or take state.channel from a newer one
+            with state.lock:
+                if state.stop_event is not my_stop or my_stop.is_set():
+                    return
+                channel = sound.play(loops=-1)  # -1 means infinite loop
+                channel.set_endevent()
+                state.channel = channel
             logger.info(f"Started looping for {duration_hours} hours")
 
-            end_time = time.time() + (duration_hours * 3600)
-            while time.time() < end_time and not state.stop_event.is_set():
-                time.sleep(0.5)
-
-            pygame.mixer.music.stop()
-            if not state.stop_event.is_set():
-                logger.info("Loop duration completed")
-            state.set_status("idle")
+            # Block until stopped or the duration runs out. Whoever stopped
+            # the session has already stopped the channel.
+            if not my_stop.wait(timeout=duration_hours * 3600):
+                if state.end_session(my_stop):
+                    logger.info("Loop duration completed")
         except Exception as e:
             logger.error(f"Error in loop worker: {e}")
-            state.set_status("idle")
+            state.end_session(my_stop)
 
-    state.loop_thread = threading.Thread(target=loop_worker, daemon=True)
-    state.loop_thread.start()
+    state.loop_future = executor.submit(loop_worker)
     return True, f"Looping alarm for {duration_hours} hours"
 
 
 def stop_all():
     """Stop all audio playback immediately."""
-    state.stop_event.set()
-    pygame.mixer.music.stop()
-    state.loop_end_time = None
-    state.set_status("idle")
+    if not state.stop():
+        return True, "Already idle"
     logger.info("Stopped all audio")
     return True, "Stopped"
 
 
 def stop_delayed(delay_seconds=10):
     """Stop audio after a delay."""
-    if state.get_status() == "idle":
+    session_stop = state.begin_delayed_stop()
+    if session_stop is None:
         return False, "Nothing is playing"
 
-    state.set_status("stopping_soon")
-
     def delayed_worker():
         logger.info(f"Will stop in {delay_seconds} seconds")
-        for _ in range(delay_seconds * 10):
-            if state.stop_event.is_set() or state.get_status() == "idle":
-                return
-            time.sleep(0.1)
-        stop_all()
-        logger.info("Delayed stop executed")
-
-    state.delayed_stop_thread = threading.Thread(target=delayed_worker, daemon=True)
-    state.delayed_stop_thread.start()
+        if session_stop.wait(timeout=delay_seconds):
+            return
+        # Only stop the session this was requested for
+        if state.end_session(session_stop):
+            logger.info("Delayed stop executed")
+
+    state.delayed_stop_future = executor.submit(delayed_worker)
     return True, f"Stopping in {delay_seconds} seconds"
 
 
 def set_volume(volume_percent):
     """Set the volume (0-100)."""
     volume = max(0, min(100, volume_percent)) / 100.0
+    if abs(volume - state.volume) < 1 / 256:
+        return True, f"Volume set to {volume_percent}%"
     state.volume = volume
-    pygame.mixer.music.set_volume(volume)
+    state.invalidate_info()
+    if state.sound:
+        state.sound.set_volume(volume)
     logger.info(f"Volume set to {volume_percent}%")
     return True, f"Volume set to {volume_percent}%"
 
 
+def end_event_watcher():
+    """Reset the status to idle when a single play finishes."""
+    while True:
+        event = pygame.event.wait()
+        if event.type == ALARM_END_EVENT:
+            state.finish_play()
+
+
+threading.Thread(target=end_event_watcher, daemon=True).start()
+
+# Pool threads aren't daemons, and the executor joins them at interpreter
+# exit. Hooks registered here run before that join (they're called in
+# reverse order), so stopping playback wakes a loop worker that would
+# otherwise hold up shutdown for hours. This covers any server that
+# imports the app, not just __main__.
+threading._register_atexit(stop_all)
+
+
 # =============================================================================
 # ROUTES
 # =============================================================================
 
 
+@lru_cache(maxsize=32)
+def _result_json(success, message):
+    """Serialize a control result; the message set is small, so cache it."""
+    return orjson.dumps({"success": success, "message": message})
+
+
+def _json(payload, status=200):
+    return Response(payload, status=status, mimetype="application/json")
+
+
 @app.route("/")
 @requires_auth
 def index():
@@ -271,39 +548,35 @@ def index():
 @requires_auth
 def api_status():
     """Get current alarm status."""
-    return jsonify(state.get_info())
+    return _json(state.get_info_json())
 
 
 @app.route("/api/play", methods=["POST"])
 @requires_auth
 def api_play():
     """Play alarm once."""
-    success, message = play_once()
-    return jsonify({"success": success, "message": message})
+    return _json(_result_json(*play_once()))
 
 
 @app.route("/api/loop", methods=["POST"])
 @requires_auth
 def api_loop():
     """Play alarm on loop for 6 hours."""
-    success, message = play_loop(duration_hours=6)
-    return jsonify({"success": success, "message": message})
+    return _json(_result_json(*play_loop(duration_hours=6)))
 
 
 @app.route("/api/stop", methods=["POST"])
 @requires_auth
 def api_stop():
     """Stop immediately."""
-    success, message = stop_all()
-    return jsonify({"success": success, "message": message})
+    return _json(_result_json(*stop_all()))
 
 
 @app.route("/api/stop-delayed", methods=["POST"])
 @requires_auth
 def api_stop_delayed():
     """Stop after 10 seconds."""
-    success, message = stop_delayed(delay_seconds=10)
-    return jsonify({"success": success, "message": message})
+    return _json(_result_json(*stop_delayed(delay_seconds=10)))
 
 
 @app.route("/api/volume", methods=["POST"])
@@ -313,7 +586,10 @@ def api_volume():
     data = request.get_json() or {}
     volume = data.get("volume", 100)
     success, message = set_volume(volume)
-    return jsonify({"success": success, "message": message, "volume": volume})
+    # Echo the clamped value rather than the raw input, which orjson may reject
+    volume = round(state.volume * 100)
+    payload = {"success": success, "message": message, "volume": volume}
+    return _json(orjson.dumps(payload))
 
 
 # =============================================================================
@@ -327,7 +603,14 @@ if __name__ == "__main__":
     exists, path = check_alarm_file()
     if exists:
         logger.info(f"Alarm file: {path}")
+        load_alarm_sound(path)
     else:
         logger.warning(f"Alarm file not found! Please add: {get_alarm_path()}")
 
-    app.run(host=HOST, port=PORT, debug=False, threaded=True)
+    serve(
+        app,
+        host=HOST,
+        port=PORT,
+        threads=SERVER_THREADS,
+        connection_limit=CONNECTION_LIMIT,
+    )